@@ -1,19 +1,56 @@
+import hashlib
+import importlib.util
 import io
+import os
+import struct
+import threading
 import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
-from PIL import Image
+import numpy as np
+import PIL
+from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
 import streamlit as st
+from streamlit.logger import get_logger
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ---------- Optional background remover ----------
 
+# rembg pulls in ONNX Runtime and friends (seconds of cold start), so only
+# check that it is installed here; it is imported on first use.
+HAS_REMBG = importlib.util.find_spec("rembg") is not None
+
+# int8 weights for the rembg model need ONNX Runtime's quantization tools,
+# which in turn need the onnx package.
+HAS_QUANTIZATION = HAS_REMBG and importlib.util.find_spec("onnx") is not None
+
+# ---------- Pillow build check ----------
+
+@st.cache_resource(show_spinner=False)
+def log_pillow_build() -> bool:
+    """
+    Log once per server process whether Pillow-SIMD (versions end in
+    .postN) or stock Pillow is doing the resizes and composites.
+    """
+    simd = ".post" in PIL.__version__
+    # Streamlit's logger has a stderr handler at INFO; the root logger doesn't.
+    get_logger(__name__).info(
+        "Using %s %s", "Pillow-SIMD" if simd else "stock Pillow", PIL.__version__
+    )
+    return simd
+
+
+log_pillow_build()
+
+# ---------- Optional SIMD Deflate for the striped PNG encoder ----------
+
 try:
-    from rembg import remove
-    HAS_REMBG = True
-    REMBG_ERROR = ""
-except Exception as e:
-    HAS_REMBG = False
-    REMBG_ERROR = repr(e)
+    from zlib_ng import zlib_ng as zlib
+except ImportError:
+    import zlib
 
 # ---------- Streamlit page setup ----------
 
@@ -56,93 +93,86 @@ with col2:
     else:
         st.caption("Background removal unavailable (rembg not installed).")
 
-st.markdown("---")
-
-layout_mode = st.radio(
-    "Layout",
-    ["Side-by-side", "Overlay (hero + front)"],
-    horizontal=True,
-)
-
-# Background mode
-bg_mode = st.radio(
-    "Background",
-    ["White", "Transparent PNG"],
-    horizontal=True,
-)
-if bg_mode == "White":
-    bg_rgba = (255, 255, 255, 255)
-else:
-    bg_rgba = (0, 0, 0, 0)  # fully transparent
-
-# Common controls
-quality = st.selectbox(
-    "Output size (square, px)",
-    [2000, 3000, 4000, 8000, 12000, 16000],
-    index=2,
-    format_func=lambda x: f"{x} x {x} px",
-)
-
-gap_ratio = None
-overlay_distance_ratio = None
-overlay_drop_ratio = None
-overlay_scale_ratio = None
-
-# Side-by-side spacing + padding
-st.markdown("### Global spacing")
-if layout_mode == "Side-by-side":
-    gap_ratio = st.slider(
-        "Gap between products (% of canvas width) [side-by-side only]",
-        0, 15, 4,
-        help="Controls the white gap between the two packs."
-    )
+# u2netp is ~4x faster than u2net on CPU and good enough for packshots.
+REMBG_MODELS = {
+    "u2netp (fast)": "u2netp",
+    "u2net (quality)": "u2net",
+    "isnet-general-use": "isnet-general-use",
+}
+if HAS_QUANTIZATION:
+    # Dynamic int8 quantization: 4x smaller weights. Speed depends on the
+    # CPU (Conv becomes ConvInteger, often slower than float32), so measure.
+    REMBG_MODELS["u2netp int8 (experimental)"] = "u2netp-int8"
+rembg_model = "u2netp"
+if HAS_REMBG:
+    rembg_model = REMBG_MODELS[st.selectbox(
+        "Background removal model",
+        list(REMBG_MODELS),
+        index=0,
+        help="u2netp is the fastest; u2net and isnet give cleaner edges.",
+    )]
 
-outer_padding_ratio = st.slider(
-    "Outer padding (left & right, and top & bottom) (% of canvas size)",
-    0, 25, 5,   # <-- increased max here
-    help="Controls the margin around the packs. 0 = almost full-bleed."
-)
+st.markdown("---")
 
-# Overlay fine-tuning
-if layout_mode == "Overlay (hero + front)":
-    st.markdown("### Overlay fine-tuning")
-    overlay_distance_ratio = st.slider(
-        "Distance between packs (%)",
-        -1000, 1000, 40,   # <-- updated range
-        help=(
-            "Horizontal position of the **front** pack relative to center.\n"
-            "0 = centered; positive = move right; negative = move left."
-        ),
-    )
-    overlay_drop_ratio = st.slider(
-        "Front pack drop (%)",
-        0, 1000, 80,      # <-- updated range
-        help=(
-            "How far to drop the front pack down from vertical center.\n"
-            "Higher = closer to the bottom of the canvas."
-        ),
-    )
-    overlay_scale_ratio = st.slider(
-        "Front pack size vs hero (%)",
-        30, 120, 60,
-        help="Relative size of front pack vs hero (100% = same visual height).",
-    )
+# Resize filters for the download; the preview always uses BICUBIC.
+RESAMPLE_FILTERS = {
+    "LANCZOS": Image.Resampling.LANCZOS,
+    "BICUBIC": Image.Resampling.BICUBIC,
+    "BILINEAR": Image.Resampling.BILINEAR,
+}
 
-st.markdown("---")
+# zlib levels for PNG output.
+PNG_COMPRESSION = {"Fast": 1, "Balanced": 3, "Small": 6}
 
 
 # ---------- HELPERS ----------
 
-def load_image_from_file_or_url(file, url) -> Optional[Image.Image]:
-    """Priority: file upload > URL > None."""
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    """
+    Pooled HTTP session shared across reruns, so two images from the same
+    CDN reuse one TCP/TLS connection.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+MAX_DOWNLOAD_BYTES = 50 * 1024 * 1024
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def fetch_url(url: str) -> bytes:
+    """Download an image; cached so re-generating doesn't re-download."""
+    with get_http_session().get(url, timeout=10, stream=True) as resp:
+        resp.raise_for_status()
+        if int(resp.headers.get("Content-Length", 0)) > MAX_DOWNLOAD_BYTES:
+            raise ValueError(f"Image is larger than {MAX_DOWNLOAD_BYTES >> 20} MB")
+        # Join the chunks once at the end: a single copy of the body.
+        chunks, total = [], 0
+        for chunk in resp.iter_content(64 * 1024):
+            chunks.append(chunk)
+            total += len(chunk)
+            if total > MAX_DOWNLOAD_BYTES:
+                raise ValueError(f"Image is larger than {MAX_DOWNLOAD_BYTES >> 20} MB")
+        return b"".join(chunks)
+
+
+def load_image_from_file_or_url(file, url) -> Optional[bytes]:
+    """
+    Priority: file upload > URL > None.
+    Returns the encoded image bytes; see decode_for_canvas for decoding.
+    """
     if file is not None:
-        return Image.open(file).convert("RGBA")
+        return file.getvalue()
 
     if url:
         try:
-            resp = requests.get(url, timeout=10)
-            resp.raise_for_status()
-            return Image.open(io.BytesIO(resp.content)).convert("RGBA")
+            data = fetch_url(url)
+            Image.open(io.BytesIO(data)).close()  # header check: report bad URLs here
+            return data
         except Exception as e:
             st.error(f"Failed to load image from URL: {url}\n{e}")
             return None
@@ -150,114 +180,327 @@ def load_image_from_file_or_url(file, url) -> Optional[Image.Image]:
     return None
 
 
-def maybe_remove_bg(img: Image.Image, do_remove: bool) -> Image.Image:
-    """Remove background for a single image if requested & rembg available."""
-    if HAS_REMBG and do_remove:
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        data = buf.getvalue()
-        out = remove(data)
-        return Image.open(io.BytesIO(out)).convert("RGBA")
+def percent_of(value: int, ratio: float) -> int:
+    """`ratio` percent of `value`, truncated to whole pixels."""
+    return int(value * (ratio / 100.0))
+
+
+def source_size_hint(
+    canvas_size: int,
+    layout: str,
+    padding_ratio: float,
+    scale_ratio: Optional[float],
+) -> int:
+    """
+    Largest size (px) an input can be drawn at for this layout: every image
+    fits inside the padded area, except that the overlay's front pack is
+    sized relative to the hero and may exceed it.
+    """
+    avail = canvas_size - 2 * percent_of(canvas_size, padding_ratio)
+    if layout == "Overlay (hero + front)" and scale_ratio:
+        return max(avail, percent_of(avail, scale_ratio))
+    return avail
+
+
+def has_alpha(img: Image.Image) -> bool:
+    return img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+
+
+def tight_crop(img: Image.Image) -> Image.Image:
+    """
+    Crop an RGBA image to its visible (alpha > 0) box: less to resize and
+    paste, and the layout then frames the product itself rather than its
+    transparent margin. Other modes and fully transparent images are
+    returned as-is.
+    """
+    if img.mode != "RGBA":
+        return img
+    bbox = img.getbbox()
+    if bbox and bbox != (0, 0) + img.size:
+        return img.crop(bbox)
     return img
 
 
-def paste_with_alpha(bg: Image.Image, fg: Image.Image, x: int, y: int):
-    if fg.mode == "RGBA":
-        bg.paste(fg, (x, y), fg)
-    else:
-        bg.paste(fg, (x, y))
+def reduce_for(img: Image.Image, max_dim: int) -> tuple:
+    """
+    Box-reduce() by the largest integer factor that keeps both sides
+    >= max_dim. Returns `(image, reduced)`.
+    """
+    factor = min(img.width // max_dim, img.height // max_dim)
+    if factor < 2:
+        return img, False
+    return img.reduce(factor), True
 
 
-def combine_side_by_side(
-    img1: Image.Image,
-    img2: Image.Image,
-    canvas_size: int,
-    gap_ratio: float,
-    padding_ratio: float,
-    bg_color: tuple,
-) -> Image.Image:
-    """Side-by-side layout, centered in both directions."""
-    canvas = Image.new("RGBA", (canvas_size, canvas_size), bg_color)
+def decode_for_canvas(data: bytes, max_dim: Optional[int]) -> tuple:
+    """
+    Decode as RGB (RGBA if transparent, trimmed to the visible box), shrunk
+    by JPEG draft / reduce() while both sides stay >= max_dim (None: full
+    size). Returns `(image, drafted)`: whether it is below full resolution.
+    """
+    # convert() always copies, so the decoder's own buffer can go at once.
+    with Image.open(io.BytesIO(data)) as img:
+        full_size = img.size
+        if img.format == "JPEG" and max_dim is not None:
+            img.draft("RGB", (max_dim, max_dim))
+        drafted = img.size != full_size
+        img = img.convert("RGBA" if has_alpha(img) else "RGB")
+    # Apply the EXIF orientation once, so the canvas and rembg (which would
+    # transpose its input again) both see the upright image.
+    if img.getexif().get(0x0112, 1) != 1:  # 0x0112: Orientation
+        img = ImageOps.exif_transpose(img)
+    # Trim first: the reduce factor must come from what is actually placed.
+    img = tight_crop(img)
+    if max_dim is None:
+        return img, drafted
+    img, reduced = reduce_for(img, max_dim)
+    return img, drafted or reduced
+
+
+def quantized_model_path(model: str) -> str:
+    """
+    Path of an int8 (dynamic quantization) copy of rembg's `model` weights,
+    written next to rembg's own model files on first use.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from rembg import new_session
+
+    home = os.path.expanduser(os.getenv(
+        "U2NET_HOME", os.path.join(os.getenv("XDG_DATA_HOME", "~"), ".u2net")
+    ))
+    src = os.path.join(home, f"{model}.onnx")
+    dst = os.path.join(home, f"{model}.int8.onnx")
+    if not os.path.exists(dst):
+        if not os.path.exists(src):
+            new_session(model)  # downloads the float32 weights
+        # Write aside and rename, so an interrupted run never leaves a
+        # truncated model behind for the exists() check above.
+        tmp = os.path.join(home, f"{model}.int8.{os.getpid()}.tmp.onnx")
+        try:
+            quantize_dynamic(src, tmp, weight_type=QuantType.QInt8)
+            os.replace(tmp, dst)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return dst
 
-    gap_px = int(canvas_size * (gap_ratio / 100.0))
-    padding_px = int(canvas_size * (padding_ratio / 100.0))
 
-    avail_width = canvas_size - 2 * padding_px - gap_px
-    avail_height = canvas_size - 2 * padding_px
+@st.cache_resource(show_spinner=False)
+def get_rembg_session(model: str):
+    """
+    One rembg (ONNX Runtime) session per model and server process, shared
+    across reruns, browser sessions and both images, so the weights are
+    loaded once instead of on every remove() call.
+    """
+    from rembg import new_session
+
+    if model.endswith("-int8"):
+        path = quantized_model_path(model[: -len("-int8")])
+        return new_session("u2net_custom", model_path=path,
+                           providers=["CPUExecutionProvider"])
+    return new_session(model)
+
+
+REMBG_MAX_SIDE = 1024  # rembg input size; the mask is upscaled back
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def remove_bg_mask(digest: str, model: str, _img: Image.Image) -> np.ndarray:
+    """
+    rembg's foreground mask (uint8, H x W) for an image, cached on the
+    pixels' digest and model so that re-generating with other layout
+    settings skips the model entirely. The single-band mask keeps entries small.
+    """
+    from rembg import remove
 
-    w1, h1 = img1.size
-    w2, h2 = img2.size
+    # rembg takes and returns PIL images as-is (no array round-trip).
+    session = get_rembg_session(model)
+    return np.asarray(remove(_img, session=session, only_mask=True))
 
-    scale_by_width = avail_width / float(w1 + w2)
-    scale_by_height = min(avail_height / float(h1),
-                          avail_height / float(h2))
 
-    scale = min(scale_by_width, scale_by_height)
+def maybe_remove_bg(img: Image.Image, do_remove: bool, model: str = "u2netp") -> Image.Image:
+    """Remove background for a single image if requested & rembg available."""
+    if HAS_REMBG and do_remove:
+        # The network sees 320 px anyway; running rembg on a small copy
+        # keeps its full-resolution post-processing out of the picture.
+        small = img
+        if max(img.size) > REMBG_MAX_SIDE:
+            small = img.copy()
+            small.thumbnail((REMBG_MAX_SIDE, REMBG_MAX_SIDE), Image.Resampling.BILINEAR)
+        # Hand rembg the decoded image: no PNG encode/decode on either side.
+        digest = hashlib.blake2b(small.tobytes(), digest_size=16)
+        digest.update(repr((small.mode, small.size)).encode())
+        try:
+            mask = Image.fromarray(remove_bg_mask(digest.hexdigest(), model, small), "L")
+        except Exception as e:
+            if model.endswith("-int8"):
+                # Quantizing and running ConvInteger depend on the ONNX
+                # Runtime build; fall back to the float32 weights.
+                fp32 = model[: -len("-int8")]
+                st.warning(f"int8 model failed, using {fp32} instead: {e}")
+                return maybe_remove_bg(img, do_remove, fp32)
+            if not isinstance(e, (ImportError, OSError)):
+                raise
+            # rembg is only imported here: report a broken install (e.g. a
+            # missing ONNX Runtime library) instead of failing the page.
+            st.error(f"Background removal unavailable: {e}")
+            return img
+        if mask.size != small.size:
+            # Only the thumbnail-to-full upscale is expected; anything else
+            # means the mask does not line up with the image.
+            st.error(f"Background removal returned a {mask.size} mask for a {small.size} image")
+            return img
+        if small is not img:
+            mask = mask.resize(img.size, Image.Resampling.BICUBIC)
+        # Attach the mask as alpha ourselves instead of rembg's full-size
+        # cutout composite (which also darkens soft edges).
+        img.putalpha(mask)
+        img = tight_crop(img)
+    return img
+
+
+def run_pair(call1: tuple, call2: tuple) -> tuple:
+    """
+    Run two `(fn, *args)` calls on worker threads and return both results.
+    The workers are attached to the current script run so st.* calls made
+    inside them (errors, caches) behave as on the main thread.
+    """
+    ctx = get_script_run_ctx()
 
-    new_w1, new_h1 = int(w1 * scale), int(h1 * scale)
-    new_w2, new_h2 = int(w2 * scale), int(h2 * scale)
+    def attached(fn, *args):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
 
-    img1_res = img1.resize((new_w1, new_h1), Image.Resampling.LANCZOS)
-    img2_res = img2.resize((new_w2, new_h2), Image.Resampling.LANCZOS)
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f1 = ex.submit(attached, *call1)
+        f2 = ex.submit(attached, *call2)
+        return f1.result(), f2.result()
 
-    total_width = new_w1 + gap_px + new_w2
-    start_x = (canvas_size - total_width) // 2
 
-    x1 = start_x
-    x2 = start_x + new_w1 + gap_px
+CANVAS_POOL_SIZE = 2
+CANVAS_POOL_MIN_SIZE = 4000  # smaller canvases are cheap to allocate
 
-    y1 = (canvas_size - new_h1) // 2
-    y2 = (canvas_size - new_h2) // 2
+# From this size up PNG downloads are encoded stripe by stripe (no full
+# canvas in memory). Its fixed Sub filter makes photo-like output ~1.6x
+# larger than Image.save's adaptive filters, so smaller sizes use Pillow.
+# The on-page preview is never larger than PREVIEW_SIZE.
+STRIPED_EXPORT_MIN_SIZE = 8000
+STRIPE_HEIGHT = 1024
+PREVIEW_SIZE = 1024
 
-    paste_with_alpha(canvas, img1_res, x1, y1)
-    paste_with_alpha(canvas, img2_res, x2, y2)
 
+def make_canvas(canvas_size: int, bg_color: tuple, mode: str = "RGBA") -> Image.Image:
+    """
+    Blank canvas in `mode` ("RGB" for opaque backgrounds). From
+    CANVAS_POOL_MIN_SIZE up, up to CANVAS_POOL_SIZE buffers are kept per
+    browser session and cleared with a fill-paste, instead of allocating
+    (up to 1 GB at 16000 px) on every click. The result is only valid
+    until the next call with the same size and mode.
+    """
+    bg_color = bg_color[:len(mode)]
+    if canvas_size < CANVAS_POOL_MIN_SIZE:
+        return Image.new(mode, (canvas_size, canvas_size), bg_color)
+    pool = st.session_state.setdefault("canvas_pool", OrderedDict())
+    key = (canvas_size, mode)
+    canvas = pool.pop(key, None)
+    if canvas is None:
+        canvas = Image.new(mode, (canvas_size, canvas_size), bg_color)
+    else:
+        canvas.paste(bg_color, (0, 0, canvas_size, canvas_size))
+    pool[key] = canvas
+    while len(pool) > CANVAS_POOL_SIZE:
+        pool.popitem(last=False)
     return canvas
 
 
-def combine_overlay(
-    img_hero: Image.Image,
-    img_front: Image.Image,
+def resize_image(img: Image.Image, size: tuple, resample: Image.Resampling) -> Image.Image:
+    """
+    Resize to `size` in two stages: a cheap integer box reduce() that keeps
+    the image at >= 2x the target, then `resample` for the exact size.
+    An image that already has the target size is returned as-is, and exact
+    integer-factor downscales are a single reduce().
+    """
+    if img.size == tuple(size):
+        return img
+    new_w, new_h = size
+    fx, fy = img.width // max(new_w, 1), img.height // max(new_h, 1)
+    if fx >= 2 and fy >= 2 and (fx * new_w, fy * new_h) == img.size:
+        return img.reduce((fx, fy))
+    factor = min(img.width // max(new_w, 1), img.height // max(new_h, 1)) // 2
+    if factor >= 2:
+        img = img.reduce(factor)
+    return img.resize(size, resample)
+
+
+def paste_with_alpha(bg: Image.Image, fg: Image.Image, x: int, y: int):
+    """
+    Composite `fg` over the RGBA canvas `bg` at (x, y) in a single
+    Image.alpha_composite pass ("over" operator), clipped to the canvas.
+    Opaque (RGB) foregrounds are a plain paste; on an opaque RGB canvas
+    the "over" reduces to a paste masked by fg's own alpha.
+    """
+    if fg.mode != "RGBA" or bg.mode == "RGB":
+        bg.paste(fg, (x, y), fg if fg.mode == "RGBA" else None)
+        return
+
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + fg.width, bg.width), min(y + fg.height, bg.height)
+    if right <= left or bottom <= top:
+        return
+    bg.alpha_composite(fg, (left, top), (left - x, top - y, right - x, bottom - y))
+
+
+# Layouts are computed on (N, 2) arrays of image sizes and return target
+# sizes and top-left positions; place_images() turns them into placements:
+# a list of (resized image, x, y) that compose() / encode_png_striped() render.
+
+def compute_layout(
+    sizes: np.ndarray,
     canvas_size: int,
+    layout: str,
     padding_ratio: float,
-    distance_ratio: float,
-    drop_ratio: float,
-    scale_ratio: float,
-    bg_color: tuple,
-) -> Image.Image:
+    gap_ratio: float = 0.0,
+    distance_ratio: float = 0.0,
+    drop_ratio: float = 0.0,
+    scale_ratio: float = 100.0,
+) -> tuple:
     """
-    Overlay layout:
-    - Hero pack centered and scaled to fit within padding.
-    - Front pack scaled vs hero height and positioned using sliders:
-        * distance_ratio: horizontal shift from center (-300..300).
-        * drop_ratio: how far to drop from vertical center (0..300).
+    Return `(target_sizes, positions)`, int arrays of shape (N, 2).
+
+    Side-by-side: all images in one row at a common scale, centered in
+    both directions (works for any N).
+    Overlay: image 0 is the hero, centered and scaled to fit within
+    padding; image 1 is the front pack, scaled vs hero height and
+    positioned using sliders:
+        * distance_ratio: horizontal shift from center (-1000..1000).
+        * drop_ratio: how far to drop from vertical center (0..1000).
     """
-    canvas = Image.new("RGBA", (canvas_size, canvas_size), bg_color)
+    sizes = np.asarray(sizes, dtype=np.float64)
+    padding_px = percent_of(canvas_size, padding_ratio)
+    avail = canvas_size - 2 * padding_px
 
-    padding_px = int(canvas_size * (padding_ratio / 100.0))
+    if layout == "Side-by-side":
+        gap_px = percent_of(canvas_size, gap_ratio)
+        avail_width = avail - gap_px * (len(sizes) - 1)
 
-    # --- Scale hero to fit nicely in padded area ---
-    avail_width = canvas_size - 2 * padding_px
-    avail_height = canvas_size - 2 * padding_px
+        scale = min(avail_width / sizes[:, 0].sum(), np.min(avail / sizes[:, 1]))
+        target = (sizes * scale).astype(int)
 
-    hw, hh = img_hero.size
-    hero_scale = min(avail_width / float(hw), avail_height / float(hh))
-
-    hero_w, hero_h = int(hw * hero_scale), int(hh * hero_scale)
-    hero_res = img_hero.resize((hero_w, hero_h), Image.Resampling.LANCZOS)
+        total_width = target[:, 0].sum() + gap_px * (len(sizes) - 1)
+        start_x = (canvas_size - total_width) // 2
+        xs = start_x + np.concatenate(([0], np.cumsum(target[:-1, 0] + gap_px)))
+        ys = (canvas_size - target[:, 1]) // 2
+        return target, np.stack([xs, ys], axis=1)
 
+    # --- Overlay: scale hero to fit nicely in padded area ---
+    hero_w, hero_h = (sizes[0] * np.min(avail / sizes[0])).astype(int)
     hero_x = (canvas_size - hero_w) // 2
     hero_y = (canvas_size - hero_h) // 2
 
-    paste_with_alpha(canvas, hero_res, hero_x, hero_y)
-
     # --- Scale front relative to hero height ---
-    fw, fh = img_front.size
-    target_front_h = int(hero_h * (scale_ratio / 100.0))
-    front_scale = target_front_h / float(fh)
-    front_w, front_h = int(fw * front_scale), target_front_h
-
-    front_res = img_front.resize((front_w, front_h), Image.Resampling.LANCZOS)
+    fw, fh = sizes[1]
+    front_h = percent_of(hero_h, scale_ratio)
+    front_w = int(fw * (front_h / fh))
 
     # --- Horizontal position: distance_ratio moves center left/right ---
     center_x = canvas_size // 2
@@ -272,75 +515,423 @@ def combine_overlay(
 
     # --- Vertical position: drop from center downwards ---
     center_y = canvas_size // 2
-    max_drop = canvas_size - padding_px - front_h - center_y
-    max_drop = max(0, max_drop)
+    max_drop = max(0, canvas_size - padding_px - front_h - center_y)
     drop_px = int((drop_ratio / 100.0) * max_drop * 2)  # extra reach
 
-    front_y = center_y + drop_px
-    front_y = min(canvas_size - padding_px - front_h, front_y)
+    front_y = min(canvas_size - padding_px - front_h, center_y + drop_px)
+
+    target = np.array([[hero_w, hero_h], [front_w, front_h]])
+    positions = np.array([[hero_x, hero_y], [front_x, front_y]])
+    return target, positions
 
-    paste_with_alpha(canvas, front_res, front_x, front_y)
 
+def place_images(
+    images: list,
+    canvas_size: int,
+    layout: str,
+    resample: Image.Resampling = Image.Resampling.LANCZOS,
+    **layout_params,
+) -> list:
+    """
+    Resize `images` for `layout` and return their placements. RGBA images
+    are trimmed to their visible (alpha > 0) box, with the position moved
+    to match, so pastes skip the fully transparent margins; fully
+    transparent images are left out.
+    """
+    sizes = np.array([img.size for img in images])
+    target, positions = compute_layout(sizes, canvas_size, layout, **layout_params)
+
+    def place(img, wh, xy):
+        img = resize_image(img, (int(wh[0]), int(wh[1])), resample)
+        x, y = int(xy[0]), int(xy[1])
+        if img.mode == "RGBA":
+            bbox = img.getbbox()
+            if bbox is None:
+                return None
+            if bbox != (0, 0) + img.size:
+                img = img.crop(bbox)
+                x, y = x + bbox[0], y + bbox[1]
+        return img, x, y
+
+    # Pillow releases the GIL while resampling: resize the images in parallel.
+    with ThreadPoolExecutor(max_workers=len(images)) as ex:
+        placements = list(ex.map(place, images, target, positions))
+    return [p for p in placements if p is not None]
+
+
+def compose(placements: list, canvas_size: int, bg_color: tuple,
+            mode: str = "RGBA") -> Image.Image:
+    """Paste placements onto a (pooled) canvas."""
+    canvas = make_canvas(canvas_size, bg_color, mode)
+    for img, x, y in placements:
+        paste_with_alpha(canvas, img, x, y)
     return canvas
 
 
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return (struct.pack(">I", len(data)) + tag + data
+            + struct.pack(">I", zlib.crc32(tag + data)))
+
+
+def encode_png_striped(
+    placements: list,
+    canvas_size: int,
+    bg_color: tuple,
+    mode: str,
+    compress_level: int = 1,
+    stripe_h: int = STRIPE_HEIGHT,
+) -> bytes:
+    """
+    Render placements straight to PNG bytes (mode "RGB" or "RGBA"), one
+    horizontal stripe at a time, so the full canvas is never held in
+    memory. Rows use PNG's Sub filter, computed with NumPy.
+    """
+    channels = len(mode)
+    color_type = 6 if mode == "RGBA" else 2
+    ihdr = struct.pack(">IIBBBBB", canvas_size, canvas_size, 8, color_type, 0, 0, 0)
+    parts = [b"\x89PNG\r\n\x1a\n", _png_chunk(b"IHDR", ihdr)]
+    z = zlib.compressobj(compress_level)
+
+    for top in range(0, canvas_size, stripe_h):
+        bottom = min(top + stripe_h, canvas_size)
+        tile = Image.new(mode, (canvas_size, bottom - top), bg_color[:channels])
+        for img, x, y in placements:
+            lo, hi = max(y, top), min(y + img.height, bottom)
+            if lo < hi:
+                strip = img.crop((0, lo - y, img.width, hi - y))
+                paste_with_alpha(tile, strip, x, lo - top)
+
+        rows = np.asarray(tile).reshape(bottom - top, -1)
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 1  # filter type: Sub
+        filtered[:, 1:channels + 1] = rows[:, :channels]
+        np.subtract(rows[:, channels:], rows[:, :-channels],
+                    out=filtered[:, channels + 1:])
+        data = z.compress(filtered)
+        if data:
+            parts.append(_png_chunk(b"IDAT", data))
+
+    parts.append(_png_chunk(b"IDAT", z.flush()))
+    parts.append(_png_chunk(b"IEND", b""))
+    return b"".join(parts)
+
+
+def render_output(
+    images: list,
+    layout: str,
+    layout_params: dict,
+    quality: int,
+    bg_mode: str,
+    bg_color: tuple,
+    file_format: str,
+    compress_level: int,
+    resample: Image.Resampling,
+) -> tuple:
+    """
+    Compose `images` and encode them. Returns `(preview_data, out_data)`:
+    the encoded on-page preview and the full-size download file.
+    """
+    def place(canvas_size: int, resample=resample) -> list:
+        return place_images(images, canvas_size, layout, resample, **layout_params)
+
+    out_mode = "RGB" if bg_mode == "White" else "RGBA"
+
+    # The on-page preview is composed from the sources at a small
+    # working size rather than downscaled from the full canvas.
+    # White output is composed on an RGB canvas: no alpha band to carry
+    # through the pastes or to drop afterwards.
+    preview = compose(
+        place(PREVIEW_SIZE, Image.Resampling.BICUBIC),
+        PREVIEW_SIZE,
+        bg_color,
+        out_mode,
+    )
+    # Encode the preview ourselves, with fast settings; st.image passes
+    # encoded bytes through instead of re-encoding a PIL image.
+    with io.BytesIO() as buf:
+        if bg_mode == "White":
+            preview.save(buf, format="JPEG", quality=90)
+        else:
+            preview.save(buf, format="PNG", compress_level=1)
+        preview_data = buf.getvalue()
+    preview.close()
+
+    if file_format == "PNG" and quality >= STRIPED_EXPORT_MIN_SIZE:
+        # Stream the full-size PNG stripe by stripe, no full canvas.
+        out_data = encode_png_striped(
+            place(quality),
+            quality,
+            bg_color,
+            out_mode,
+            compress_level,
+        )
+        return preview_data, out_data
+
+    result = compose(
+        place(quality),
+        quality,
+        bg_color,
+        out_mode,
+    )
+    with io.BytesIO() as buf:
+        if file_format == "WebP":
+            result.save(buf, format="WEBP", quality=95, method=4)
+        else:
+            result.save(buf, format="PNG", compress_level=compress_level)
+        out_data = buf.getvalue()
+    return preview_data, out_data
+
+
 # ---------- MAIN ACTION ----------
 
-if st.button("✨ Generate Combined Image", type="primary"):
-    img1 = load_image_from_file_or_url(img_file_1, img_url_1)
-    img2 = load_image_from_file_or_url(img_file_2, img_url_2)
+def process_inputs(max_dim: int) -> Optional[tuple]:
+    """
+    Load both inputs, decode them for `max_dim` and remove backgrounds as
+    requested. Returns `(images, drafted)`, where `drafted` tells whether an
+    image is below full resolution (JPEG draft or reduce()), or None if an
+    image is missing.
+    """
+    if img_file_1 is None and img_file_2 is None and img_url_1 and img_url_2:
+        # Both images come over the network: overlap the two downloads.
+        data1, data2 = run_pair(
+            (load_image_from_file_or_url, img_file_1, img_url_1),
+            (load_image_from_file_or_url, img_file_2, img_url_2),
+        )
+    else:
+        data1 = load_image_from_file_or_url(img_file_1, img_url_1)
+        data2 = load_image_from_file_or_url(img_file_2, img_url_2)
+
+    if data1 is None or data2 is None:
+        return None
+
+    # Decode only now that the target size is known (JPEG draft). Background
+    # removal crops to the product, whose size is only known afterwards:
+    # those images are decoded in full and reduced after the crop.
+    (img1, drafted1), (img2, drafted2) = run_pair(
+        (decode_for_canvas, data1, None if remove_bg_1 else max_dim),
+        (decode_for_canvas, data2, None if remove_bg_2 else max_dim),
+    )
+    drafted = drafted1 or drafted2
+
+    if remove_bg_1 and remove_bg_2:
+        # rembg spends its time inside ONNX Runtime, which releases the GIL
+        # (and whose InferenceSession.run is thread-safe), so both overlap.
+        images = run_pair(
+            (maybe_remove_bg, img1, remove_bg_1, rembg_model),
+            (maybe_remove_bg, img2, remove_bg_2, rembg_model),
+        )
+    else:
+        images = (
+            maybe_remove_bg(img1, remove_bg_1, rembg_model),
+            maybe_remove_bg(img2, remove_bg_2, rembg_model),
+        )
+    images, reduced = zip(*(
+        reduce_for(img, max_dim) if do_remove else (img, False)
+        for img, do_remove in zip(images, (remove_bg_1, remove_bg_2))
+    ))
+    return images, drafted or any(reduced)
+
+
+def input_key() -> tuple:
+    """Identifies the current inputs, so stale results are not re-composed."""
+    files = tuple(f.file_id if f is not None else None for f in (img_file_1, img_file_2))
+    return files, img_url_1, img_url_2, remove_bg_1, remove_bg_2, rembg_model
+
+
+@st.fragment
+def composer():
+    """
+    Layout controls, preview and download. This runs as a fragment: a
+    settings change (submitted with Generate, or a radio switch) re-composes
+    from the processed images kept in st.session_state and only reruns this
+    function; loading and background removal rerun only for new inputs.
+    """
+    layout_mode = st.radio(
+        "Layout",
+        ["Side-by-side", "Overlay (hero + front)"],
+        horizontal=True,
+    )
 
-    if img1 is None or img2 is None:
-        st.error("Please provide both images (via upload or URL).")
+    # Background mode
+    bg_mode = st.radio(
+        "Background",
+        ["White", "Transparent PNG"],
+        horizontal=True,
+    )
+    if bg_mode == "White":
+        bg_rgba = (255, 255, 255, 255)
     else:
+        bg_rgba = (0, 0, 0, 0)  # fully transparent
+
+    # WebP keeps the alpha channel but is far smaller and faster to encode.
+    file_format = "PNG"
+    if bg_mode == "Transparent PNG":
+        file_format = st.radio(
+            "File format",
+            ["PNG", "WebP"],
+            horizontal=True,
+            help="WebP (quality 95) is 5-10x smaller than PNG and quicker to encode.",
+        )
+
+    # The remaining settings are batched in a form: dragging a slider no
+    # longer re-composes (and re-encodes) the full-size output each step;
+    # it's applied together with the rest on Generate.
+    with st.form("layout_params", border=False):
+        # PNG is lossless at every level; higher levels only trade time for size.
+        compress_level = 1
+        if file_format == "PNG":
+            compress_level = PNG_COMPRESSION[st.selectbox(
+                "PNG compression",
+                list(PNG_COMPRESSION),
+                index=0,
+                help="Fast encodes several times quicker; Small gives slightly smaller files.",
+            )]
+
+        # Common controls
+        quality = st.selectbox(
+            "Output size (square, px)",
+            [2000, 3000, 4000, 8000, 12000, 16000],
+            index=2,
+            format_func=lambda x: f"{x} x {x} px",
+        )
+
+        resample_name = st.selectbox(
+            "Resample filter",
+            list(RESAMPLE_FILTERS),
+            index=0,
+            help="Used for the download: LANCZOS is the sharpest but slowest. "
+                 "The preview always uses BICUBIC.",
+        )
+        resample = RESAMPLE_FILTERS[resample_name]
+
+        gap_ratio = None
+        overlay_distance_ratio = None
+        overlay_drop_ratio = None
+        overlay_scale_ratio = None
+
+        # Side-by-side spacing + padding
+        st.markdown("### Global spacing")
+        if layout_mode == "Side-by-side":
+            gap_ratio = st.slider(
+                "Gap between products (% of canvas width) [side-by-side only]",
+                0, 15, 4,
+                help="Controls the white gap between the two packs."
+            )
+
+        outer_padding_ratio = st.slider(
+            "Outer padding (left & right, and top & bottom) (% of canvas size)",
+            0, 25, 5,   # <-- increased max here
+            help="Controls the margin around the packs. 0 = almost full-bleed."
+        )
+
+        # Overlay fine-tuning
+        if layout_mode == "Overlay (hero + front)":
+            st.markdown("### Overlay fine-tuning")
+            overlay_distance_ratio = st.slider(
+                "Distance between packs (%)",
+                -1000, 1000, 40,   # <-- updated range
+                help=(
+                    "Horizontal position of the **front** pack relative to center.\n"
+                    "0 = centered; positive = move right; negative = move left."
+                ),
+            )
+            overlay_drop_ratio = st.slider(
+                "Front pack drop (%)",
+                0, 1000, 80,      # <-- updated range
+                help=(
+                    "How far to drop the front pack down from vertical center.\n"
+                    "Higher = closer to the bottom of the canvas."
+                ),
+            )
+            overlay_scale_ratio = st.slider(
+                "Front pack size vs hero (%)",
+                30, 120, 60,
+                help="Relative size of front pack vs hero (100% = same visual height).",
+            )
+
+        st.markdown("---")
+
+        generate = st.form_submit_button("✨ Generate Combined Image", type="primary")
+
+    max_dim = source_size_hint(quality, layout_mode, outer_padding_ratio,
+                               overlay_scale_ratio)
+
+    # Settings changes also submit the form; only (re)load and remove
+    # backgrounds for new inputs, or when the current ones were decoded too
+    # small for these settings (e.g. a layout switch outside the form),
+    # which re-decodes without waiting for a click.
+    processed = st.session_state.get("processed")
+    current = processed is not None and processed["inputs"] == input_key()
+    too_small = (current and processed["max_dim"] is not None
+                 and max_dim > processed["max_dim"])
+    if (generate and not current) or too_small:
         with st.spinner("Processing images..."):
-            img1_proc = maybe_remove_bg(img1, remove_bg_1)
-            img2_proc = maybe_remove_bg(img2, remove_bg_2)
-
-            if layout_mode == "Side-by-side":
-                result = combine_side_by_side(
-                    img1_proc,
-                    img2_proc,
-                    quality,
-                    gap_ratio,
-                    outer_padding_ratio,
-                    bg_rgba,
-                )
-            else:
-                result = combine_overlay(
-                    img1_proc,
-                    img2_proc,
-                    quality,
-                    outer_padding_ratio,
-                    overlay_distance_ratio,
-                    overlay_drop_ratio,
-                    overlay_scale_ratio,
-                    bg_rgba,
-                )
-
-        st.success("Done! Preview below 👇")
-        st.image(result, caption="Combined SKU Image", use_column_width=True)
-
-        # ---------- Prepare for download ----------
-        if bg_mode == "White":
-            # Flatten RGBA onto white for clean white background
-            out_img = Image.new("RGB", result.size, (255, 255, 255))
-            out_img.paste(result, mask=result.split()[-1])  # use alpha channel
-        else:
-            # Keep transparency
-            out_img = result
-
-        buf = io.BytesIO()
-        out_img.save(buf, format="PNG")
-        buf.seek(0)
-
-        st.download_button(
-            label=f"⬇️ Download PNG ({quality} x {quality})",
-            data=buf,
-            file_name=f"combined_sku_{quality}px.png",
-            mime="image/png",
+            loaded = process_inputs(max_dim)
+        if loaded is None:
+            st.session_state.pop("processed", None)
+            st.error("Please provide both images (via upload or URL).")
+            return
+        images, drafted = loaded
+        st.session_state["processed"] = {
+            "inputs": input_key(),
+            "images": images,
+            # Larger outputs than this would upscale a reduced decode.
+            "max_dim": max_dim if drafted else None,
+        }
+
+    processed = st.session_state.get("processed")
+    if processed is None or processed["inputs"] != input_key():
+        return
+    img1_proc, img2_proc = processed["images"]
+
+    if layout_mode == "Side-by-side":
+        layout_params = dict(
+            padding_ratio=outer_padding_ratio,
+            gap_ratio=gap_ratio,
+        )
+    else:
+        layout_params = dict(
+            padding_ratio=outer_padding_ratio,
+            distance_ratio=overlay_distance_ratio,
+            drop_ratio=overlay_drop_ratio,
+            scale_ratio=overlay_scale_ratio,
         )
 
+    # Reruns with unchanged settings (e.g. the download click) reuse the
+    # last output; it lives on `processed`, so Generate invalidates it.
+    output_key = (layout_mode, tuple(layout_params.items()), quality, bg_mode,
+                  file_format, compress_level, resample)
+    output = processed.get("output")
+    if output is None or output["key"] != output_key:
+        with st.spinner("Composing..."):
+            preview_data, out_data = render_output(
+                [img1_proc, img2_proc], layout_mode, layout_params, quality,
+                bg_mode, bg_rgba, file_format, compress_level, resample,
+            )
+        output = processed["output"] = {
+            "key": output_key,
+            "preview": preview_data,
+            "data": out_data,
+        }
+
+    st.success("Done! Preview below 👇")
+    st.image(
+        output["preview"],
+        caption="Combined SKU Image",
+        use_container_width=True,
+    )
+
+    ext = file_format.lower()
+    st.download_button(
+        label=f"⬇️ Download {file_format} ({quality} x {quality})",
+        data=output["data"],
+        file_name=f"combined_sku_{quality}px.{ext}",
+        mime=f"image/{ext}",
+    )
+
+
+composer()
+
 st.markdown("---")
 st.markdown(
     "<p style='text-align:center; font-size: 12px; opacity: 0.7;'>"
@@ -0,0 +1,30 @@
+import importlib.util
+import io
+from pathlib import Path
+
+from PIL import Image
+
+APP = Path(__file__).resolve().parent.parent / "app.py"
+
+
+def load_app():
+    # app.py is a Streamlit script; importing it renders in bare mode.
+    spec = importlib.util.spec_from_file_location("app", APP)
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    return app
+
+
+def jpeg_with_orientation(size, orientation):
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buf = io.BytesIO()
+    Image.new("RGB", size, (200, 40, 40)).save(buf, "JPEG", exif=exif.tobytes())
+    return buf.getvalue()
+
+
+def test_decode_applies_exif_orientation():
+    app = load_app()
+    img, _ = app.decode_for_canvas(jpeg_with_orientation((1024, 683), 6), None)
+    assert img.size == (683, 1024)
+    assert img.getexif().get(0x0112, 1) == 1